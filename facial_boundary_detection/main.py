@@ -11,7 +11,7 @@ def run():
     fpath_img = Path(args.image_path)
     fpath_obj = Path(args.obj_path)
     fpath_bound = Path(args.boundary_path)
-    if args.get("chunk_path"):
+    if args.chunk_path:
         fpath_chunk = Path(args.chunk_path)
     else:
         fpath_chunk = None
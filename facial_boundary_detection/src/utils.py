@@ -1,42 +1,60 @@
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import io
+import mmap
+import os
 from pathlib import Path
 import re
-from typing import Dict, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
-from box import Box
 import numpy as np
 
+# dtype of parsed vertex and texture coordinates. Single precision covers the
+# ~7 significant digits .obj files carry and halves the memory of every array.
+DTYPE = np.float32
 
-def center_object(obj: np.ndarray):
+# Wavefront vertex (3D) and texture (2D) lines, capturing the numbers only
+# (without a CRLF file's trailing \r)
+_V_RE = re.compile(rb"v[ \t]+([^\r\n]*)")
+_VT_RE = re.compile(rb"vt[ \t]+([^\r\n]*)")
+# triangular faces in either WaveFront format, `f v/vt/vn ...` or `f v/vt ...`,
+# capturing the vertex index of each corner. Files are scanned as bytes, so
+# CRLF line endings are accepted explicitly.
+_FACE_CORNER = rb" (\d+)/\d*(?:/\d*)?"
+_FACE_RE = re.compile(rb"f" + _FACE_CORNER * 3 + rb"\r?\n")
+
+
+def center_object(obj: np.ndarray, out: Optional[np.ndarray] = None):
     """Center the values along each dimension.
 
-    The .txt files have 6 columns
+    The .txt files have 6 columns. Pass `out=obj` to center in place.
     """
-    centered_obj = obj.copy()
-    # center along each dimension
-    _, col = centered_obj.shape
+    # nothing to center, e.g. a file without any vertices
+    if obj.size == 0:
+        return obj.copy() if out is None else out
+
+    _, col = obj.shape
 
     # only take the vertex information
     csize = col if col < 4 else col // 2
-    centered_obj = centered_obj[:, :csize]
-
-    for c in range(csize):
-        if c == 2:
-            pass
-        # dimension min/max
-        dim_min = obj[:, c].min()
-        dim_max = obj[:, c].max()
-
-        dim_center = dim_min + ((dim_max - dim_min) // 2)
+    coords = obj[:, :csize]
 
-        dim_shift = 0 - dim_center
-        centered_obj[:, c] = obj[:, c] + dim_shift
+    # dimension min/max, computed for all columns at once
+    dim_min = coords.min(axis=0)
+    dim_max = coords.max(axis=0)
+    dim_center = dim_min + ((dim_max - dim_min) // 2)
 
     # works for pixels and voxels
-    return np.hstack([centered_obj, obj[:, csize:]])
+    centered_obj = np.empty_like(obj) if out is None else out
+    np.subtract(coords, dim_center, out=centered_obj[:, :csize])
+    if centered_obj is not obj:
+        centered_obj[:, csize:] = obj[:, csize:]
+    return centered_obj
 
 
-def get_boundary_fpath(fname: Path, **kwargs) -> str:
+def get_boundary_fpath(fname: Path, **kwargs) -> Path:
     extension = kwargs.get("extension", "")
     fpath = fname.parent
     new_path = fpath / "boundary" / fname.name
@@ -47,23 +65,23 @@ def get_boundary_fpath(fname: Path, **kwargs) -> str:
         else:
             new_path = new_path.with_suffix(f".{extension}")
 
-    Path(new_path).parent.mkdir(parents=True, exist_ok=True)
-    return new_path.as_posix()
+    new_path.parent.mkdir(parents=True, exist_ok=True)
+    return new_path
 
 
-def get_new_fpath(fname: Path, new_dir: str):
+def get_new_fpath(fname: Path, new_dir: str) -> Path:
     extension = ".txt"
     data_dir = fname.parent
     path_ = data_dir / new_dir / fname.stem
     new_path = path_.with_suffix(extension)
     
     # Ensure the path to the file exists
-    Path(new_path).parent.mkdir(parents=True, exist_ok=True)
+    new_path.parent.mkdir(parents=True, exist_ok=True)
 
-    return new_path.as_posix()
+    return new_path
 
 
-def parse_cli() -> ArgumentParser:
+def parse_cli() -> Namespace:
     ap = ArgumentParser()
     ap.add_argument(
         "--image_path",
@@ -103,22 +121,69 @@ def parse_cli() -> ArgumentParser:
         dest="skip_boundary",
         action="store_true",
     )
-    args = ap.parse_args()
-    args = Box(args.__dict__)
+    return ap.parse_args()
+
+
+@contextmanager
+def map_file(in_fpath: Path) -> Iterator[Union[mmap.mmap, bytes]]:
+    """Memory map a file read-only, so it can be scanned without copying it.
+
+    An empty file can't be mapped, so it yields `b""` instead.
+    """
+    with open(in_fpath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield buf
 
-    return args
 
+def read_many(in_fpaths: List[Path], max_pending: int = 4) -> Iterator[bytes]:
+    """Read several files in order, with up to `max_pending` reads in flight.
 
-def preprocess_pixels(in_fpath: Path, center: bool = False) -> Tuple[np.ndarray, Path]:
-    with open(in_fpath, "r") as pix:
-        p_ = pix.read()
+    The blocking reads run on a thread pool; file reads release the GIL, so
+    the next files are read while the caller works on the current one. At
+    most `max_pending` files are held in memory at a time.
+    """
+    with ThreadPoolExecutor(max_workers=max_pending) as ex:
+        pending: deque = deque()
+        for fpath in in_fpaths:
+            pending.append(ex.submit(Path.read_bytes, fpath))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_obj_rows(
+    in_fpath: Path, pattern: re.Pattern, data: Optional[bytes] = None
+) -> np.ndarray:
+    """Parse every row of numbers matched by `pattern` into a 2D array.
+
+    The file is memory mapped and scanned once; the matched lines go straight
+    to numpy's C parser, which also checks every row has the same number of
+    columns. If the file was already read, pass its contents as `data` to skip
+    opening it again.
+    """
+    if data is not None:
+        rows = pattern.findall(data)
+    else:
+        with map_file(in_fpath) as buf:
+            rows = pattern.findall(buf)
+
+    if not rows:
+        return np.empty((0, 0), DTYPE)
+
+    return np.loadtxt(rows, dtype=DTYPE, ndmin=2)
 
-    pixels = re.findall("vt\ .*", p_)
-    pixels = [p.replace("vt ", "").replace(" ", ",").split(",") for p in pixels]
-    px = np.array(pixels, float)
+
+def preprocess_pixels(
+    in_fpath: Path, center: bool = False, data: Optional[bytes] = None
+) -> Tuple[np.ndarray, Path]:
+    px = read_obj_rows(in_fpath, _VT_RE, data)
 
     if center:
-        px = center_object(px)
+        px = center_object(px, out=px)
         fname_out = in_fpath.with_name(f"{in_fpath.stem}_centered.txt")
     else:
         fname_out = in_fpath
@@ -126,31 +191,46 @@ def preprocess_pixels(in_fpath: Path, center: bool = False) -> Tuple[np.ndarray,
 
 
 def preprocess_voxels(
-    in_fpath: Path, center: bool = False, trim_z: float = 1.0
+    in_fpath: Path,
+    center: bool = False,
+    trim_z: float = 1.0,
+    data: Optional[bytes] = None,
 ) -> Tuple[np.ndarray, Path]:
-    with open(in_fpath, "r") as vox:
-        v_ = vox.read()
-
-    voxels = re.findall("v\ .*", v_)
-    voxels = [
-        v.replace("v ", "").replace(" ", ",").replace("\n", "").split(",")
-        for v in voxels
-    ]
-    vx = np.array(voxels, float)
+    vx = read_obj_rows(in_fpath, _V_RE, data)
+    # the freshly parsed array is ours, so center and trim it in place
     if center:
-        vx = center_object(vx)
+        vx = center_object(vx, out=vx)
         fname_out = in_fpath.with_name(f"{in_fpath.stem}_centered.txt")
     else:
         fname_out = in_fpath
 
     trim_z = trim_z if trim_z <= 1.0 and trim_z >= 0.0 else 1.0
-    if trim_z != 1.0:
-        trim_min = vx[:, 2].min() * trim_z
-        vx[:, 2] = np.maximum(vx[:, 2], trim_min)
+    if trim_z != 1.0 and vx.size:
+        trim_min = vx[:, 2].min() * vx.dtype.type(trim_z)
+        np.maximum(vx[:, 2], trim_min, out=vx[:, 2])
 
     return vx, fname_out
 
 
+def preprocess_pixels_batch(
+    in_fpaths: List[Path], center: bool = False, max_pending: int = 4
+) -> Iterator[Tuple[np.ndarray, Path]]:
+    """Run `preprocess_pixels` over many files, reading ahead while parsing."""
+    for fpath, data in zip(in_fpaths, read_many(in_fpaths, max_pending)):
+        yield preprocess_pixels(fpath, center=center, data=data)
+
+
+def preprocess_voxels_batch(
+    in_fpaths: List[Path],
+    center: bool = False,
+    trim_z: float = 1.0,
+    max_pending: int = 4,
+) -> Iterator[Tuple[np.ndarray, Path]]:
+    """Run `preprocess_voxels` over many files, reading ahead while parsing."""
+    for fpath, data in zip(in_fpaths, read_many(in_fpaths, max_pending)):
+        yield preprocess_voxels(fpath, center=center, trim_z=trim_z, data=data)
+
+
 def process_obj_file(in_fpath: Path):
     """Split the input .obj file into voxel and texture files.
 
@@ -162,42 +242,30 @@ def process_obj_file(in_fpath: Path):
     a clean way of parsing out the voxels from the texture points
     using regular expressions.
     """
-    voxel_re = re.compile("v\ ")
-    texture_re = re.compile("vt\ ")
-
     dirpath_out = in_fpath
     fname_voxel = dirpath_out.with_name(f"{in_fpath.stem}_voxels.txt")
     fname_texture = dirpath_out.with_name(f"{in_fpath.stem}_texture.txt")
 
-    with open(in_fpath.resolve().as_posix(), "r") as f:
-        with open(fname_voxel.resolve().as_posix(), "w") as two, open(
-            fname_texture.resolve().as_posix(), "w"
-        ) as three:
-            for line in f.readlines():
-                if voxel_re.search(line):
-                    two.write(f"{line[2:]}")
+    with map_file(in_fpath.resolve()) as buf:
+        for pattern, fname in ((_V_RE, fname_voxel), (_VT_RE, fname_texture)):
+            rows = pattern.findall(buf)
+            with open(fname.resolve().as_posix(), "wb") as out:
+                if rows:
+                    out.write(b"\n".join(rows))
+                    out.write(b"\n")
 
-                if texture_re.search(line):
-                    three.write(f"{line[3:]}")
 
+def process_obj_files(in_fpaths: List[Path], max_workers: Optional[int] = None):
+    """Run `process_obj_file` over many .obj files in parallel processes.
 
-def update_vertex_indices(face_string: str, mapping: Dict[int, int]) -> str:
-    """Update the vertex indices to adjust for points I filtered out.
-
-    Args:
-        face_string (str): A string in the form `f int1/int1 int2/int2 int3/int3`.
-        mapping (Dict[int, int]): A mapping between a vertex's index in the input file and output file.
-
-    Returns:
-        (str) A string in the form `f int1/int1 int2/int2 int3/int3`.
-
+    Each file is split independently, so the work spreads across cores. Files
+    are handed out in chunks so a large batch doesn't pay the dispatch cost
+    once per file.
     """
-    updated_idxs = "f "
-    fs = [int(x.split("/")[0]) for x in face_string[2:].strip().split(" ")]
-    for idx in fs:
-        updated_idxs += str(mapping[idx]) + "/" + str(mapping[idx]) + " "
-    updated_idxs = updated_idxs[:-1]
-    return updated_idxs + "\n"
+    workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(in_fpaths) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(process_obj_file, in_fpaths, chunksize=chunksize))
 
 
 def write_points(
@@ -206,10 +274,21 @@ def write_points(
     point_dir: str = "keypoints",
 ):
     fpath_metrics = get_new_fpath(fpath_out, point_dir)
+    lines = [
+        f"{k} {' '.join([str(v) for v in p['xyz']])}\n" for k, p in keypoints.items()
+    ]
     with open(fpath_metrics, "w+") as fmp:
-        for k, v in keypoints.items():
-            vox = v["xyz"]
-            fmp.write(f"{k} {' '.join([str(v) for v in vox])}\n")
+        fmp.write("".join(lines))
+
+
+def row_format(prefix: str, n_cols: int, dtype: np.dtype = DTYPE) -> str:
+    """Build an `np.savetxt` format for an .obj line, e.g. `v %.9g %.9g %.9g`.
+
+    Values get enough significant digits to round-trip their dtype: 9 for
+    float32 and narrower, 17 for float64.
+    """
+    spec = "%.9g" if np.dtype(dtype).itemsize <= 4 else "%.17g"
+    return " ".join([prefix] + [spec] * n_cols)
 
 
 def write_object(
@@ -220,47 +299,58 @@ def write_object(
     vertices: np.ndarray,
     **kwargs,
 ) -> None:
-    """Create an .obj file using the texture and vertices data."""
+    """Create an .obj file using the texture and vertices data.
+
+    Coordinates are written with enough digits to round-trip their dtype.
+    """
     d = {"prefix": "masked", "suffix": "object", "extension": "obj"}
     d.update(kwargs)
 
-    # map to translate unfiltered index values to filtered values
-    idx_mapping = {}
-
-    get_vertex_indices = lambda a: set(
-        [int(x.split("/")[0]) for x in a[2:].strip().split(" ")]
-    )
-
     fpath_selected = get_boundary_fpath(fpath_out, **d)
 
-    with open(fpath_selected, "w") as s:
-        # TODO: Should I include a 'material' .mtl file in the header?
-        # create an index set
-        index_ = set(index)
-        # write vertices (3D) first
-        for i, idx in enumerate(index):
-            line = vertices[idx]
-            # indices start at 1 for .obj files
-            idx_mapping[idx] = i + 1
-            s.write(f"v {' '.join([str(s) for s in line])}\n")
-
-        # write texture (2D) second
-        for lin in texture[index]:
-            s.write(f"vt {' '.join([str(s) for s in lin])}\n")
-
-        with open(fpath_obj, "r") as f_obj:
-            read = f_obj.read()
-            # two different WaveFront object face formats. This makes sure both use
-            # cases are accounted for
-            format1 = re.findall("(f(?:\ \d*\/\d*\/\d*){3}\\n)", read)
-            format2 = re.findall("(f(?:\ \d*\/\d*){3}\\n)", read)
-            format = format1 if len(format1) > len(format2) else format2
-
-            # for every face in the mesh...
-            for face_idxs in format:
-                vtx = get_vertex_indices(face_idxs)
-
-                # make sure all the face vertices are within the boundary
-                if len(vtx.intersection(index_)) == 3:
-                    updated_idxs = update_vertex_indices(face_idxs, idx_mapping)
-                    s.write(updated_idxs)
+    # an empty selection arrives as a float array, which can't index
+    index = np.asarray(index, dtype=np.intp)
+
+    # the vertex index of every face corner as an (F, 3) array. Both face
+    # formats are matched in the same scan, and the captured indices are
+    # converted by numpy's C parser rather than one tuple at a time.
+    with map_file(fpath_obj) as buf:
+        corners = [b" ".join(c) for c in _FACE_RE.findall(buf)]
+    faces = np.empty((0, 3), dtype=np.int64)
+    if corners:
+        faces = np.loadtxt(corners, dtype=np.int64, ndmin=2)
+
+    # map to translate unfiltered index values to filtered values,
+    # indices start at 1 for .obj files so 0 marks vertices outside the
+    # boundary
+    size = max(index.max(initial=0), faces.max(initial=0)) + 1
+    idx_mapping = np.zeros(size, dtype=np.int64)
+    idx_mapping[index] = np.arange(1, len(index) + 1)
+
+    # one lookup both remaps the corners and tells us whether all the
+    # face vertices are within the boundary. Degenerate faces that repeat a
+    # vertex are dropped.
+    mapped = idx_mapping[faces]
+    a, b, c = faces.T
+    keep = mapped.all(axis=1) & (a != b) & (b != c) & (a != c)
+    remapped = mapped[keep]
+
+    # assemble the whole file in memory so it goes out in a single write
+    # TODO: Should I include a 'material' .mtl file in the header?
+    out = io.BytesIO()
+    # write vertices (3D) first
+    v_fmt = row_format("v", vertices.shape[1], vertices.dtype)
+    np.savetxt(out, vertices[index], fmt=v_fmt)
+
+    # write texture (2D) second
+    vt_fmt = row_format("vt", texture.shape[1], texture.dtype)
+    np.savetxt(out, texture[index], fmt=vt_fmt)
+
+    # every corner is written as `vertex/texture` with the same index, and
+    # the whole block is formatted by a single `%` call
+    pairs = np.repeat(remapped, 2, axis=1)
+    faces_txt = ("f %d/%d %d/%d %d/%d\n" * len(pairs)) % tuple(pairs.ravel().tolist())
+    out.write(faces_txt.encode())
+
+    with open(fpath_selected, "wb") as s:
+        s.write(out.getbuffer())